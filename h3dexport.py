@@ -1,12 +1,13 @@
 import bpy
+import sys
 import struct
 import bmesh
 from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty
+from bpy.props import StringProperty, BoolProperty, EnumProperty, IntProperty
 from bpy.types import Operator
-from mathutils import Matrix, Vector
+from mathutils import Matrix
 from math import pi
-from collections import OrderedDict
+from array import array
 
 
 ###############################################
@@ -31,6 +32,15 @@ def vec3_mul_scalar(vec, s):
 def vec3_average(u, v):
     return [(u[0]+v[0]/2), (u[1]+v[1]/2), (u[1]+v[1]/2)]
 
+def vec3_cross(u, v):
+    return [u[1]*v[2]-u[2]*v[1], u[2]*v[0]-u[0]*v[2], u[0]*v[1]-u[1]*v[0]]
+
+def vec3_normalize(vec):
+    length = (vec[0]*vec[0] + vec[1]*vec[1] + vec[2]*vec[2]) ** 0.5
+    if length == 0.0:
+        return vec
+    return vec3_mul_scalar(vec, 1.0/length)
+
 class H3dMesh:
     def __init__(self):
         self.name = ""
@@ -43,6 +53,9 @@ class H3dMesh:
         self.h3d_shape_keys = []
         self.shape_keys_original_values = {}
         self.shape_keys = []
+        self.buffers = None
+        self.submeshes = []  # (material index, first index, index count)
+        self.source_ranges = []  # (object name, first index, index count, first vertex, vertex count)
 
 
 class H3dKeyframe:
@@ -73,24 +86,62 @@ class H3dArmature:
         self.joints = []
 
 
-class H3dVertex:
-    def __init__(self, position, normal, uv, bones, index):
-        self.position = position
-        self.normal = normal
-        self.uv = uv
-        self.bones = bones
-        self.index = index
-        self.original_index = index
-        self.tangent = []
-        self.bitangent = []
-        
-        
-class H3dTriangle:
-    def __init__(self, v1, v2, v3):
-        self.indices = [v1, v2, v3] 
+class H3dMeshBuffers:
+    """Structure of arrays holding the vertices and triangles of a group in typed contiguous arrays"""
+    def __init__(self, num_bones=0):
+        self.num_bones = num_bones
+        self.positions = array('f')
+        self.normals = array('f')
+        self.tangents = array('f')
+        self.bitangents = array('f')
+        self.uvs = array('f')
+        self.bone_indices = array('i')  # num_bones entries per vertex
+        self.bone_weights = array('f')  # num_bones entries per vertex
+        self.original_indices = array('i')  # Loop each vertex was created from
+        self.indices = array('i')  # Three entries per triangle
+        self.submeshes = []  # (material index, first index, index count) ranges into indices
+
+    def vertex_count(self):
+        return len(self.original_indices)
+
+    def triangle_count(self):
+        return len(self.indices) // 3
+
+    def gather_vertices(self, vertex_indices):
+        # Build a new buffer holding only the given vertices (in that order), triangles are not copied
+        gathered = H3dMeshBuffers(self.num_bones)
+        nb = self.num_bones
+        for vi in vertex_indices:
+            gathered.positions.extend(self.positions[vi*3:vi*3+3])
+            gathered.normals.extend(self.normals[vi*3:vi*3+3])
+            gathered.tangents.extend(self.tangents[vi*3:vi*3+3])
+            gathered.bitangents.extend(self.bitangents[vi*3:vi*3+3])
+            gathered.uvs.extend(self.uvs[vi*2:vi*2+2])
+            gathered.bone_indices.extend(self.bone_indices[vi*nb:vi*nb+nb])
+            gathered.bone_weights.extend(self.bone_weights[vi*nb:vi*nb+nb])
+            gathered.original_indices.append(self.original_indices[vi])
+        return gathered
+
+    def append_buffers(self, other):
+        # Concatenate the vertices and triangles of other, returns where they start in this buffer
+        first_index = len(self.indices)
+        first_vertex = self.vertex_count()
+        self.positions.extend(other.positions)
+        self.normals.extend(other.normals)
+        self.tangents.extend(other.tangents)
+        self.bitangents.extend(other.bitangents)
+        self.uvs.extend(other.uvs)
+        self.bone_indices.extend(other.bone_indices)
+        self.bone_weights.extend(other.bone_weights)
+        self.original_indices.extend(other.original_indices)
+        self.indices.extend(vi + first_vertex for vi in other.indices)
+        return first_index, first_vertex
+
 
 correction_matrix = Matrix.Rotation(-pi/2, 4, 'X')
 
+H3D_VERSION = 4
+
 
 def binary_write_string(f, string):
     count = len(string)
@@ -108,30 +159,38 @@ def mesh_triangulate(me):
     bm.free()
     
 
-def get_unique_vertices(vertices, triangles):
-    helper_dict = OrderedDict()
-    new_index = 0
-    for vertex in vertices:
-        key = "{p[0]:.3f}{p[1]:.3f}{p[2]:.3f}{n[0]:.3f}{n[0]:.3f}{n[0]:.3f}{t[0]:.3f}{t[1]:.3f}"
-        key = key.format(p=vertex.position, n=vertex.normal, t=vertex.uv)
+def get_unique_vertices(buffers):
+    helper_dict = {}
+    remap = array('i', [0]) * buffers.vertex_count()
+    unique_indices = array('i')
+    p = buffers.positions
+    n = buffers.normals
+    t = buffers.uvs
+    for vi in range(buffers.vertex_count()):
+        key = (round(p[vi*3], 3), round(p[vi*3+1], 3), round(p[vi*3+2], 3),
+               round(n[vi*3], 3), round(n[vi*3+1], 3), round(n[vi*3+2], 3),
+               round(t[vi*2], 3), round(t[vi*2+1], 3))
         if key not in helper_dict:
-            vertex.index = new_index
-            new_index += 1
-            helper_dict[key] = vertex
-        else:
-            existing_v = helper_dict[key]
-            vertex.index = existing_v.index
-            existing_v.tangent = (existing_v.tangent + vertex.tangent)/2.0
-            existing_v.bitangent = (existing_v.bitangent + vertex.bitangent)/2.0
-    
-    new_vertices = list(helper_dict.values())
-    
+            helper_dict[key] = len(unique_indices)
+            unique_indices.append(vi)
+        remap[vi] = helper_dict[key]
+
+    new_buffers = buffers.gather_vertices(unique_indices)
+
+    # Average the tangent space of the duplicates into the vertex that was kept
+    for vi in range(buffers.vertex_count()):
+        ni = remap[vi]
+        if unique_indices[ni] == vi:
+            continue
+        for c in range(3):
+            new_buffers.tangents[ni*3+c] = (new_buffers.tangents[ni*3+c] + buffers.tangents[vi*3+c])/2.0
+            new_buffers.bitangents[ni*3+c] = (new_buffers.bitangents[ni*3+c] + buffers.bitangents[vi*3+c])/2.0
+
     # Update the triangle indexes
-    for triangle in triangles:
-        for i, vi in enumerate(triangle.indices):
-            triangle.indices[i] = vertices[vi].index
-            
-    return new_vertices
+    new_buffers.indices = array('i', (remap[vi] for vi in buffers.indices))
+    new_buffers.submeshes = buffers.submeshes
+
+    return new_buffers
 
 
 def fill_keyframes(scene, h3d_armature):
@@ -155,13 +214,19 @@ def fill_keyframes(scene, h3d_armature):
             h3d_joint.keyframes.append(keyframe)
 
 
-def write_armature(f, textual, armature):
+def matrix_to_column_major(matrix):
+    return [matrix[row][column] for column in range(4) for row in range(4)]
+
+
+def write_armature(f, textual, armature, export_bind_matrices=False):
     if textual:
         f.write("%s\n" % armature.name)
         f.write("Joint count: %d\n" % len(armature.joints))
+        f.write("Bind matrices:%s\n" % export_bind_matrices)
     else:
         binary_write_string(f, armature.name)
         f.write(struct.pack("<1i", len(armature.joints)))
+        f.write(struct.pack("<1b", 1 if export_bind_matrices else 0))
         
     for joint in armature.joints:
         if textual:
@@ -169,6 +234,9 @@ def write_armature(f, textual, armature):
             f.write("p %f %f %f\n" % (joint.position[0], joint.position[1], joint.position[2]))
             f.write("r %f %f %f\n" % (joint.rotation[0], joint.rotation[1], joint.rotation[2]))
             f.write("< %d\n" % joint.parentIndex)
+            if export_bind_matrices:
+                inverse_bind_matrix = matrix_to_column_major(joint.matrix.inverted_safe())
+                f.write("ib" + " %f"*16 % tuple(inverse_bind_matrix) + "\n")
             f.write("Keyframes: %d\n" % len(joint.keyframes))
             for keyframe in joint.keyframes:
                 f.write("f %d\n" % keyframe.frame)
@@ -180,6 +248,8 @@ def write_armature(f, textual, armature):
             f.write(struct.pack("<3f", *joint.position))
             f.write(struct.pack("<3f", *joint.rotation))
             f.write(struct.pack("<1i", joint.parentIndex))
+            if export_bind_matrices:
+                f.write(struct.pack("<16f", *matrix_to_column_major(joint.matrix.inverted_safe())))
             f.write(struct.pack("<1i", len(joint.keyframes)))
             for keyframe in joint.keyframes:
                 f.write(struct.pack("<1i3f3f", keyframe.frame, *keyframe.position, *keyframe.rotation))
@@ -205,13 +275,22 @@ def prepare_armatures(armatures_list):
 
             armature.joints_dic[joint.name] = joint
 
-        # Create an ordered list and assign the parent indexes
-        armature.joints = list(armature.joints_dic.values())
+        # Create an ordered list where parents always come before their children
+        children = {}
+        for joint in armature.joints_dic.values():
+            children.setdefault(joint.parentName, []).append(joint)
+        armature.joints = list(children.get("", []))
+        i = 0
+        while i < len(armature.joints):
+            armature.joints.extend(children.get(armature.joints[i].name, []))
+            i += 1
+
+        # Assign the indexes and the parent indexes
+        for i, joint in enumerate(armature.joints):
+            joint.index = i
         for joint in armature.joints:
-            for i, other_joint in enumerate(armature.joints):
-                armature.joints_dic[other_joint.name].index = i
-                if joint.parentName == other_joint.name:
-                    joint.parentIndex = i
+            if joint.parentName != "":
+                joint.parentIndex = armature.joints_dic[joint.parentName].index
 
 
 def find_joint_index(armature, vertex_group):
@@ -225,150 +304,297 @@ def find_joint_by_name(armature, name):
     return armature.joints[armature.joints_dic[name].index]
 
 
-def write_vertices(f, textual, vertices, export_uv=True, export_bones=True, export_normals=True):
+def write_vertices(f, textual, buffers, export_uv=True, export_bones=True, export_normals=True):
+    count = buffers.vertex_count()
+    nb = buffers.num_bones
     if textual:
-        f.write("%d\n" % len(vertices))
+        f.write("%d\n" % count)
     else:
-        f.write(struct.pack("<1i", len(vertices)))
-    
-    for vertex in vertices:
+        f.write(struct.pack("<1i", count))
+        vertex_format = "<3f"
+        if export_normals:
+            vertex_format += "9f"
+        if export_uv:
+            vertex_format += "2f"
+        if export_bones:
+            vertex_format += "1i1f" * nb
+        vertex_struct = struct.Struct(vertex_format)
+
+    for vi in range(count):
+        position = buffers.positions[vi*3:vi*3+3]
+        normal = buffers.normals[vi*3:vi*3+3]
+        tangent = buffers.tangents[vi*3:vi*3+3]
+        bitangent = buffers.bitangents[vi*3:vi*3+3]
+        uv = buffers.uvs[vi*2:vi*2+2]
         if textual:
-            line = "v {v.x} {v.y} {v.z}\n"
-            line = line.format(v=vertex.position)
-            f.write(line)
+            f.write("v {v[0]} {v[1]} {v[2]}\n".format(v=position))
             if export_normals:
-                line = "n {n.x} {n.y} {n.z}\n"
-                line = line.format(n=vertex.normal)
-                f.write(line)
-                line = "t {t.x} {t.y} {t.z}\n"
-                line = line.format(t=vertex.tangent)
-                f.write(line)
-                line = "bt {bt.x} {bt.y} {bt.z}\n"
-                line = line.format(bt=vertex.bitangent)
-                f.write(line)
+                f.write("n {n[0]} {n[1]} {n[2]}\n".format(n=normal))
+                f.write("t {t[0]} {t[1]} {t[2]}\n".format(t=tangent))
+                f.write("bt {bt[0]} {bt[1]} {bt[2]}\n".format(bt=bitangent))
             if export_uv:
-                line = "t {t.x} {t.y}\n"
-                line = line.format(t=vertex.uv)
-                f.write(line)
+                f.write("t {t[0]} {t[1]}\n".format(t=uv))
             if export_bones:
-                for bone in vertex.bones:
-                    line = "b {j} {w}\n"
-                    line = line.format(j=bone[0], w=bone[1])
-                    f.write(line)
+                for b in range(vi*nb, vi*nb+nb):
+                    f.write("b {j} {w}\n".format(j=buffers.bone_indices[b], w=buffers.bone_weights[b]))
         else:
-            f.write(struct.pack("<3f", *vertex.position))
+            values = list(position)
             if export_normals:
-                f.write(struct.pack("<3f", *vertex.normal))
-                f.write(struct.pack("<3f", *vertex.tangent))
-                f.write(struct.pack("<3f", *vertex.bitangent))
+                values.extend(normal)
+                values.extend(tangent)
+                values.extend(bitangent)
             if export_uv:
-                f.write(struct.pack("<2f", *vertex.uv))
+                values.extend(uv)
             if export_bones:
-                for bone in vertex.bones:
-                    f.write(struct.pack("<1i1f", *bone))
+                for b in range(vi*nb, vi*nb+nb):
+                    values.append(buffers.bone_indices[b])
+                    values.append(buffers.bone_weights[b])
+            f.write(vertex_struct.pack(*values))
 
 
-def create_vertices_list(group, num_bones=3, export_armatures=True):
-    loops = group.mesh.loops
-    vertices = group.mesh.vertices
-    h3d_vertices = []
-    for i, loop in enumerate(loops):
-        vertex_groups_info = sorted(vertices[loop.vertex_index].groups, key=lambda vg: vg.weight, reverse=True)
-        # Convert the vertex_group index into an index for our joint arrays
-        bones_index_weight = []
-        if export_armatures:
-            for vg_info in vertex_groups_info:
-                index = find_joint_index(group.h3d_armature, group.vertex_groups[vg_info.group])
-                if -1 == index:
-                    continue    # This vertex_group is not part of the armature
-                weight = vg_info.weight
-                bones_index_weight.append([index, weight])
-
-        # Fill the remainder bone slots with -1
-        if len(bones_index_weight) < num_bones:
-            for c in range(len(bones_index_weight), num_bones):
-                bones_index_weight.append([-1, 0.0])
-        bones = bones_index_weight[:num_bones]
-
-        # Normalize weights
-        weight_sum = 0.0
+def get_vertex_bones(group, vertex, num_bones=3, export_armatures=True):
+    vertex_groups_info = sorted(vertex.groups, key=lambda vg: vg.weight, reverse=True)
+    # Convert the vertex_group index into an index for our joint arrays
+    bones_index_weight = []
+    if export_armatures:
+        for vg_info in vertex_groups_info:
+            index = find_joint_index(group.h3d_armature, group.vertex_groups[vg_info.group])
+            if -1 == index:
+                continue    # This vertex_group is not part of the armature
+            weight = vg_info.weight
+            bones_index_weight.append([index, weight])
+
+    # Fill the remainder bone slots with -1
+    if len(bones_index_weight) < num_bones:
+        for c in range(len(bones_index_weight), num_bones):
+            bones_index_weight.append([-1, 0.0])
+    bones = bones_index_weight[:num_bones]
+
+    # Normalize weights
+    weight_sum = 0.0
+    for bone in bones:
+        weight_sum += bone[1]
+    if weight_sum > 0:
         for bone in bones:
-            weight_sum += bone[1]
-        if weight_sum > 0:
-            for bone in bones:
-                bone[1] = bone[1]/weight_sum    
-                
-        if(group.mesh.uv_layers.active is not None):
-            uv = Vector([group.mesh.uv_layers.active.data[i].uv[0], 1-group.mesh.uv_layers.active.data[i].uv[1]])
-        else:
-            uv = Vector([0, 0])
-        
-        h3d_vertex = H3dVertex(vertices[loop.vertex_index].co, vertices[loop.vertex_index].normal, uv, bones, i)
-        #h3d_vertex = H3dVertex(vertices[loop.vertex_index].co, loop.normal, uv, bones, i)
+            bone[1] = bone[1]/weight_sum
+    return bones
 
-        h3d_vertices.append(h3d_vertex)
-        
-    return h3d_vertices
-
-def generate_h3d_tri_verts(group, num_bones, export_armatures, no_duplicates, flat=False):
-    # Get the triangles
-    h3d_triangles = []
-    for triangle in group.mesh.polygons:
-        h3d_triangle = H3dTriangle(*triangle.loop_indices)
-        h3d_triangles.append(h3d_triangle)
+
+def create_vertices_list(group, num_bones=3, export_armatures=True):
+    mesh = group.mesh
+    loops = mesh.loops
+    vertices = mesh.vertices
+    loop_count = len(loops)
+
+    vertex_indices = array('i', [0]) * loop_count
+    loops.foreach_get("vertex_index", vertex_indices)
+    co = array('f', [0.0]) * (len(vertices)*3)
+    vertices.foreach_get("co", co)
+    normals = array('f', [0.0]) * (len(vertices)*3)
+    vertices.foreach_get("normal", normals)
+
+    # Bone weights belong to the vertex, so resolve them once and share them among its loops
+    vertex_bone_indices = array('i')
+    vertex_bone_weights = array('f')
+    for vertex in vertices:
+        for index, weight in get_vertex_bones(group, vertex, num_bones, export_armatures):
+            vertex_bone_indices.append(index)
+            vertex_bone_weights.append(weight)
+
+    buffers = H3dMeshBuffers(num_bones)
+    for vi in vertex_indices:
+        buffers.positions.extend(co[vi*3:vi*3+3])
+        buffers.normals.extend(normals[vi*3:vi*3+3])
+        #buffers.normals.extend(loop normal) when using calc_normals_split
+        buffers.bone_indices.extend(vertex_bone_indices[vi*num_bones:vi*num_bones+num_bones])
+        buffers.bone_weights.extend(vertex_bone_weights[vi*num_bones:vi*num_bones+num_bones])
+
+    buffers.uvs = array('f', [0.0]) * (loop_count*2)
+    if mesh.uv_layers.active is not None:
+        mesh.uv_layers.active.data.foreach_get("uv", buffers.uvs)
+        for i in range(1, loop_count*2, 2):
+            buffers.uvs[i] = 1-buffers.uvs[i]
+
+    buffers.tangents = array('f', [0.0]) * (loop_count*3)
+    buffers.bitangents = array('f', [0.0]) * (loop_count*3)
+    buffers.original_indices = array('i', range(loop_count))
+
+    return buffers
+
+def generate_h3d_tri_verts(group, num_bones, export_armatures, no_duplicates, flat=False, slot_materials=None):
     # Get the vertexes
-    h3d_vertices = create_vertices_list(group, num_bones, export_armatures)
+    buffers = create_vertices_list(group, num_bones, export_armatures)
+    # Get the triangles (the mesh is triangulated so every polygon owns three consecutive loops)
+    polygon_count = len(group.mesh.polygons)
+    loop_starts = array('i', [0]) * polygon_count
+    group.mesh.polygons.foreach_get("loop_start", loop_starts)
+    material_indices = array('i', [0]) * polygon_count
+    group.mesh.polygons.foreach_get("material_index", material_indices)
+    # Resolve the slots into material indexes so slots sharing a material share a range
+    if slot_materials is not None:
+        material_indices = array('i', (slot_materials[slot] if slot < len(slot_materials) else -1
+                                       for slot in material_indices))
+
+    # Sort them by material so each material is drawn from one contiguous range
+    for p in sorted(range(polygon_count), key=material_indices.__getitem__):
+        material_index = material_indices[p]
+        if not buffers.submeshes or buffers.submeshes[-1][0] != material_index:
+            buffers.submeshes.append([material_index, len(buffers.indices), 0])
+        buffers.submeshes[-1][2] += 3
+        buffers.indices.extend((loop_starts[p], loop_starts[p]+1, loop_starts[p]+2))
 
     #Compute tangents and bitangents
-    for tri in h3d_triangles:
-        v0 = h3d_vertices[tri.indices[0]]
-        v1 = h3d_vertices[tri.indices[1]]
-        v2 = h3d_vertices[tri.indices[2]]
-
-        d_pos1 = v1.position - v0.position
-        d_pos2 = v2.position - v0.position
-        d_uv1 = v1.uv - v0.uv
-        d_uv2 = v2.uv - v0.uv
-        
+    p = buffers.positions
+    uv = buffers.uvs
+    indices = buffers.indices
+    for t in range(0, len(indices), 3):
+        i0, i1, i2 = indices[t], indices[t+1], indices[t+2]
+
+        d_pos1 = vec3_sub(p[i1*3:i1*3+3], p[i0*3:i0*3+3])
+        d_pos2 = vec3_sub(p[i2*3:i2*3+3], p[i0*3:i0*3+3])
+        d_uv1 = [uv[i1*2]-uv[i0*2], uv[i1*2+1]-uv[i0*2+1]]
+        d_uv2 = [uv[i2*2]-uv[i0*2], uv[i2*2+1]-uv[i0*2+1]]
+
         # r = 1.0 / (d_uv1.x * d_uv2.y - d_uv1.y * d_uv2.x)
-        tangent = ( (d_pos1 * d_uv2.y) - (d_pos2 * d_uv1.y) )  # * r
-        bitangent = ( (d_pos2 * d_uv1.x) - (d_pos1 * d_uv2.x) )  # *r
-        
-        tangent.normalize()
-        bitangent.normalize()
-        
-        v0.tangent = tangent
-        v1.tangent = tangent
-        v2.tangent = tangent        
-        v0.bitangent = bitangent
-        v1.bitangent = bitangent
-        v2.bitangent = bitangent
+        tangent = vec3_sub(vec3_mul_scalar(d_pos1, d_uv2[1]), vec3_mul_scalar(d_pos2, d_uv1[1]))  # * r
+        bitangent = vec3_sub(vec3_mul_scalar(d_pos2, d_uv1[0]), vec3_mul_scalar(d_pos1, d_uv2[0]))  # *r
 
+        tangent = vec3_normalize(tangent)
+        bitangent = vec3_normalize(bitangent)
         if flat:
-            normal = d_pos1.cross(d_pos2)
-            normal.normalize()
-            v0.normal = normal
-            v1.normal = normal
-            v2.normal = normal
+            normal = vec3_normalize(vec3_cross(d_pos1, d_pos2))
+
+        for vi in (i0, i1, i2):
+            for c in range(3):
+                buffers.tangents[vi*3+c] = tangent[c]
+                buffers.bitangents[vi*3+c] = bitangent[c]
+                if flat:
+                    buffers.normals[vi*3+c] = normal[c]
 
     if no_duplicates:
-        h3d_vertices = get_unique_vertices(h3d_vertices, h3d_triangles)
-    return h3d_triangles, h3d_vertices
+        buffers = get_unique_vertices(buffers)
+    return buffers
     
 
-def write_triangles(f, textual, h3d_triangles):
+def get_material_index(materials, materials_dic, material):
+    if material is None:
+        return -1
+    if material.name not in materials_dic:
+        materials.append(material)
+        materials_dic[material.name] = len(materials)-1
+    return materials_dic[material.name]
+
+
+def write_submeshes(f, textual, submeshes):
     if textual:
-        f.write("%d\n" % len(h3d_triangles))
+        f.write("Submeshes: %d\n" % len(submeshes))
     else:
-        f.write(struct.pack("<1i", len(h3d_triangles)))
-                
-    for triangle in h3d_triangles:
+        f.write(struct.pack("<1i", len(submeshes)))
+
+    for submesh in submeshes:
         if textual:
-            line = "tri {l[0]} {l[1]} {l[2]}\n"
-            line = line.format(l=triangle.indices)
-            f.write(line)
+            f.write("sm %d %d %d\n" % tuple(submesh))
         else:
-            f.write(struct.pack("<3i", *triangle.indices))
+            f.write(struct.pack("<3i", *submesh))
+
+
+def write_source_ranges(f, textual, source_ranges):
+    if textual:
+        f.write("Sources: %d\n" % len(source_ranges))
+    else:
+        f.write(struct.pack("<1i", len(source_ranges)))
+
+    for name, first_index, index_count, first_vertex, vertex_count in source_ranges:
+        if textual:
+            f.write("%s\n" % name)
+            f.write("src %d %d %d %d\n" % (first_index, index_count, first_vertex, vertex_count))
+        else:
+            binary_write_string(f, name)
+            f.write(struct.pack("<4i", first_index, index_count, first_vertex, vertex_count))
+
+
+def build_group_buffers(group, materials, materials_dic, num_bones, export_armatures, no_duplicates, flat_shading):
+    # Get the triangles and vertices and the material of each range of triangles
+    slot_materials = [get_material_index(materials, materials_dic, material)
+                      for material in group.mesh.materials]
+    buffers = generate_h3d_tri_verts(group, num_bones, export_armatures, no_duplicates, flat_shading,
+                                     slot_materials)
+    group.buffers = buffers
+    group.submeshes = [tuple(submesh) for submesh in buffers.submeshes]
+    group.source_ranges = [(group.name, 0, len(buffers.indices), 0, buffers.vertex_count())]
+
+
+def append_to_batch(batch, group):
+    first_index, first_vertex = batch.buffers.append_buffers(group.buffers)
+    batch.source_ranges.append((group.name, first_index, len(group.buffers.indices),
+                                first_vertex, group.buffers.vertex_count()))
+    group.buffers = None  # The batch holds the only copy now
+
+
+def batch_static_groups(groups, max_vertices):
+    # Merge the groups that are not animated, have no shape keys and use a single material into
+    # one group per material (or more if a batch would go over max_vertices)
+    final_groups = []
+    batches = []
+    batch_sources = []  # Groups merged into each batch
+    batch_vertex_counts = []
+    open_batches = {}  # material index -> index of the batch still being filled
+    for group in groups:
+        if group.animated or len(group.h3d_shape_keys) > 0 or len(group.submeshes) != 1:
+            final_groups.append(group)
+            continue
+        material_index = group.submeshes[0][0]
+        b = open_batches.get(material_index)
+        if b is None or batch_vertex_counts[b] + group.buffers.vertex_count() > max_vertices:
+            batch = H3dMesh()
+            batch.buffers = H3dMeshBuffers(group.buffers.num_bones)
+            batch.submeshes = [(material_index, 0, 0)]
+            b = len(batches)
+            batches.append(batch)
+            batch_sources.append([])
+            batch_vertex_counts.append(0)
+            open_batches[material_index] = b
+        batch = batches[b]
+        batch_sources[b].append(group)
+        batch_vertex_counts[b] += group.buffers.vertex_count()
+        # The first group is only copied once a second one joins, it might end up alone
+        if len(batch_sources[b]) == 2:
+            append_to_batch(batch, batch_sources[b][0])
+        if len(batch_sources[b]) >= 2:
+            append_to_batch(batch, group)
+            batch.submeshes = [(material_index, 0, len(batch.buffers.indices))]
+
+    # Name the batches that are written without clashing with the other groups
+    taken_names = set(group.name for group in groups)
+    batch_number = 0
+    for b, batch in enumerate(batches):
+        if len(batch_sources[b]) == 1:
+            final_groups.append(batch_sources[b][0])  # Nothing to merge it with
+            continue
+        while "StaticBatch%d" % batch_number in taken_names:
+            batch_number += 1
+        batch.name = "StaticBatch%d" % batch_number
+        taken_names.add(batch.name)
+        final_groups.append(batch)
+    return final_groups
+
+
+def write_triangles(f, textual, buffers):
+    if textual:
+        f.write("%d\n" % buffers.triangle_count())
+    else:
+        f.write(struct.pack("<1i", buffers.triangle_count()))
+
+    if textual:
+        indices = buffers.indices
+        for t in range(0, len(indices), 3):
+            f.write("tri {} {} {}\n".format(indices[t], indices[t+1], indices[t+2]))
+    else:
+        indices = buffers.indices
+        if sys.byteorder != 'little':
+            indices = array('i', indices)
+            indices.byteswap()
+        f.write(indices.tobytes())
 
 
 def group_to_h3d_mesh(scene, obj, export_armatures):
@@ -406,7 +632,8 @@ def group_to_h3d_mesh(scene, obj, export_armatures):
 
 
 def export_h3d(operator, file_path, textual, no_duplicates, num_bones, export_armatures, export_keyframes,
-               shape_keys_behaviour, flat_shading):
+               shape_keys_behaviour, flat_shading, batch_static=False, max_batch_vertices=65535,
+               export_bind_matrices=False):
     export_shape_keys = False
     apply_shape_keys = False
 
@@ -423,14 +650,15 @@ def export_h3d(operator, file_path, textual, no_duplicates, num_bones, export_ar
     print("running write_some_data...")
     if textual:
         f = open(file_path, 'w', encoding='utf-8')
-        f.write("H3D V1\n")
+        f.write("H3D V%d\n" % H3D_VERSION)
     else:
         f = open(file_path, 'wb')
-        f.write(struct.pack("<3c1b", bytes('H', 'ascii'), bytes('3', 'ascii'), bytes('D', 'ascii'), 1))
+        f.write(struct.pack("<3c1b", bytes('H', 'ascii'), bytes('3', 'ascii'), bytes('D', 'ascii'), H3D_VERSION))
 
     scene = bpy.context.scene
     groups = []
     materials = []
+    materials_dic = {}
     armatures = []
         
     for obj in scene.objects:
@@ -482,42 +710,41 @@ def export_h3d(operator, file_path, textual, no_duplicates, num_bones, export_ar
             if group.blender_armature == armature.name:
                 group.h3d_armature = armature
 
+    groups.sort(key=lambda g: g.name.lower());
+
+    # Batching needs every group up front, otherwise each group is built right before it is written
+    exported_groups = groups
+    if batch_static:
+        for group in groups:
+            build_group_buffers(group, materials, materials_dic, num_bones, export_armatures, no_duplicates,
+                                flat_shading)
+        exported_groups = batch_static_groups(groups, max_batch_vertices)
+        exported_groups.sort(key=lambda g: g.name.lower())
+
     # Write the number of groups
     if textual:
-        f.write("%d\n" % len(groups))
+        f.write("%d\n" % len(exported_groups))
     else:
-        f.write(struct.pack("<1i", len(groups)))
+        f.write(struct.pack("<1i", len(exported_groups)))
 
-    groups.sort(key=lambda g: g.name.lower());
-
-    for group in groups:
-        # Write the name of the group and its material
+    for group in exported_groups:
+        # Write the name of the group
         if textual:
             f.write("%s\n" % group.name)
         else:
             binary_write_string(f, group.name)
-        material = group.mesh.materials[0]
-        material = bpy.data.materials[material.name]
-        if material is None:
-            material_index = -1
-        else:
-            if material not in materials:
-                materials.append(material)
-                material_index = len(materials)-1
-            else:
-                material_index = materials.index(material)
-        if textual:
-            f.write("%d\n" % material_index)
-        else:
-            f.write(struct.pack("<1i", material_index))
-            
-        # Now we get the triangles and vertices
-        h3d_triangles, h3d_vertices = generate_h3d_tri_verts(group, num_bones, export_armatures, no_duplicates, flat_shading)
-        
+
+        if group.buffers is None:
+            build_group_buffers(group, materials, materials_dic, num_bones, export_armatures, no_duplicates,
+                                flat_shading)
+        buffers = group.buffers
+        write_submeshes(f, textual, group.submeshes)
+        write_source_ranges(f, textual, group.source_ranges)
+
         # Write the triangles
-        write_triangles(f, textual, h3d_triangles)
+        write_triangles(f, textual, buffers)
         # Write the vertices
-        write_vertices(f, textual, h3d_vertices)
+        write_vertices(f, textual, buffers)
 
         # declare the armature
         if not group.animated:
@@ -540,19 +767,20 @@ def export_h3d(operator, file_path, textual, no_duplicates, num_bones, export_ar
             f.write(struct.pack("<1i", len(group.h3d_shape_keys)))
 
         for shape_key in group.h3d_shape_keys:
-            sk_h3d_triangles, sk_h3d_vertices = generate_h3d_tri_verts(shape_key, num_bones=0,
-                                                                       export_armatures=False, no_duplicates=False, flat=flat_shading)
-            
+            sk_buffers = generate_h3d_tri_verts(shape_key, num_bones=0, export_armatures=False,
+                                                no_duplicates=False, flat=flat_shading)
+
             #Elininate duplicates based on the duplicate removal from the basis
-            final_sk_h3d_vertices = h3d_vertices[:]
-            for i, base_vert in enumerate(h3d_vertices):
-                final_sk_h3d_vertices[i] = sk_h3d_vertices[base_vert.original_index]
-            
+            final_sk_buffers = sk_buffers.gather_vertices(buffers.original_indices)
+
             if textual:
                 f.write("%s\n" % shape_key.name)
             else:
                 binary_write_string(f, shape_key.name)
-            write_vertices(f, textual, final_sk_h3d_vertices, False, False, False)
+            write_vertices(f, textual, final_sk_buffers, False, False, False)
+
+        # Release the buffers of this group before building the next one
+        group.buffers = None
             
     # Handle the materials
     if textual:
@@ -631,7 +859,7 @@ def export_h3d(operator, file_path, textual, no_duplicates, num_bones, export_ar
         f.write(struct.pack("<1i", len(armatures)))
     if export_armatures:
         for armature in armatures:
-            write_armature(f, textual, armature)
+            write_armature(f, textual, armature, export_bind_matrices)
     
     f.close()
     
@@ -687,6 +915,11 @@ class Hobby3dExporter(Operator, ExportHelper):
             description="Only bone location and rotation keyframes are supported",
             default=True,
             )
+    bind_matrices = BoolProperty(
+            name="Export inverse bind matrices",
+            description="Write the inverse bind matrix of each joint (column-major) so it doesn't have to be computed on load",
+            default=False,
+            )
 
     num_bones = EnumProperty(
             name="Bones per vertex",
@@ -709,6 +942,17 @@ class Hobby3dExporter(Operator, ExportHelper):
                     "Ignore shape keys (sets their value to 0 before exporting)")),
             default='1',
             )
+    batch_static = BoolProperty(
+            name="Batch static meshes",
+            description="Merge meshes that are not animated, have no shape keys and share a material into one group",
+            default=False,
+            )
+    batch_max_vertices = IntProperty(
+            name="Vertices per batch",
+            description="Start a new batch when merging a mesh would go over this many vertices",
+            default=65535,
+            min=1,
+            )
     #flat = BoolProperty(
     #    name="Flat shading",
     #    description="Export flat normals (to use with TBN)",
@@ -717,7 +961,8 @@ class Hobby3dExporter(Operator, ExportHelper):
 
     def execute(self, context):
         return export_h3d(self, self.filepath, self.textual, self.no_duplicates, int(self.num_bones), self.armatures,
-                          self.keyframes, self.shape_keys, False)
+                          self.keyframes, self.shape_keys, False, self.batch_static, self.batch_max_vertices,
+                          self.bind_matrices)
 
 
 # Only needed if you want to add into a dynamic menu